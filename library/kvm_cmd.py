@@ -18,6 +18,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.    If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import print_function
 
 DOCUMENTATION='''
 ---
@@ -49,6 +50,36 @@ options:
         default: None
         description:
             - Where VMNAME will be the name used to id the vm. when not provided a default name is generated: <vm>[-<date>][-<time>]
+    instance_disk_bus:
+        required: False
+        default: "virtio"
+        choices: [ virtio, ide ]
+        description:
+            - Bus the instance image is attached to on 'boot'. 'virtio' uses a virtio-blk device served by its own iothread, the guest sees it as vda.
+            - Set to 'ide' for guests without virtio drivers or that expect sda, this attaches the image the way -hda does.
+    instance_disk_cache:
+        required: False
+        default: "none"
+        choices: [ none, directsync, writeback, writethrough, unsafe, default ]
+        description:
+            - Cache mode of the instance disk on 'boot'. 'none' and 'directsync' bypass the host page cache and also use aio=native.
+            - Those two need O_DIRECT, use 'writeback' or 'default' for instance images on tmpfs.
+            - Set to 'default' to leave the cache mode to qemu.
+    image_format:
+        required: False
+        default: None
+        description:
+            - Format of the instance image. 'instance-create' creates a qcow2 image when not set.
+            - For 'boot' the format is probed by qemu unless this is set.
+    preallocation:
+        required: False
+        default: None
+        choices: [ 'off', metadata, falloc, full ]
+        description:
+            - Preallocation mode passed to 'qemu-img create' for new instances. 'metadata' avoids growing qcow2 tables on first boot.
+            - The value 'off' must be quoted in playbooks, YAML otherwise reads it as a boolean.
+            - Any mode except 'off' cannot be combined with 'image_base', qemu-img refuses to preallocate an image that has a backing file.
+            - Mode 'metadata' is only valid for qcow2 images.
 '''
 
 EXAMPLES='''
@@ -121,9 +152,10 @@ Boot an instance using flavor and image names (if names are unique)
 import os
 import syslog
 import sys
-import dbus
 #from gi.repository import NetworkManager, NMClient
 
+SYSLOG_IDENT='ansible-%s' % os.path.basename(__file__)
+
 
 class KvmCmd(object):
     """
@@ -136,17 +168,46 @@ class KvmCmd(object):
 
     platform='Generic'
     distribution=None
-    bus=dbus.SystemBus()
-    # The following is going to be used in dbus code
-    DEVTYPES={1: "Ethernet",
-                       15: "Team"
-                }
-    STATES={0: "Unknown",
-                 10: "Unmanaged",
-                100: "Activated",
-                 110: "Deactivating",
-                 120: "Failed"
-            }
+    # SystemBus is opened on first use only, see get_bus()
+    _bus=None
+    # fixed qemu-kvm arguments: KVM acceleration and daemonize
+    QEMU_KVM_ARGS=('-enable-kvm', '-daemonize')
+    # connection type -> (create method, modify method,
+    #   attributes that require a modify after create, bring up after modify;
+    #   types without a modify step are brought up when autoconnect is off)
+    CONNECTION_TYPES={
+        'team': ('create_connection_team', 'modify_connection_team', (), True),
+        'team-slave': ('create_connection_team_slave', 'modify_connection_team_slave', ('mtu',), False),
+        'bond': ('create_connection_bond', 'modify_connection_bond', ('mtu', 'dns4', 'dns6'), True),
+        'bond-slave': ('create_connection_bond_slave', 'modify_connection_bond_slave', (), False),
+        'ethernet': ('create_connection_ethernet', 'modify_connection_ethernet', ('mtu', 'dns4', 'dns6'), True),
+        'bridge': ('create_connection_bridge', 'modify_connection_bridge', (), False),
+        'bridge-slave': ('create_connection_bridge_slave', 'modify_connection_bridge_slave', (), False),
+        'vlan': ('create_connection_vlan', 'modify_connection_vlan', (), False),
+        'tun': ('create_connection_tun', 'modify_connection_tun', (), False),
+    }
+
+    # dbus access, nothing in the module talks to dbus yet:
+    #   get_bus()  - shared connection for code making many calls
+    #   with_bus() - private connection for a one-shot call, closed right
+    #                after so unhandled signals don't queue up on it
+    @classmethod
+    def get_bus(cls):
+        # Share a single SystemBus connection, opened lazily
+        if cls._bus is None:
+            import dbus
+            cls._bus=dbus.SystemBus()
+        return cls._bus
+
+    @classmethod
+    def with_bus(cls, fn):
+        # Run fn against a private SystemBus connection and close it again
+        import dbus.bus
+        bus=dbus.bus.BusConnection(dbus.bus.BusConnection.TYPE_SYSTEM)
+        try:
+            return fn(bus)
+        finally:
+            bus.close()
 
     def __new__(cls, *args, **kwargs):
         return load_platform_subclass(KvmCmd, args, kwargs)
@@ -162,16 +223,34 @@ class KvmCmd(object):
         self.instance_vnc=module.params['instance_vnc']
         self.instance_display=module.params['instance_display']
         self.instance_cdrom=module.params['instance_cdrom']
+        self.instance_disk_bus=module.params['instance_disk_bus']
+        self.instance_disk_cache=module.params['instance_disk_cache']
         self.image_name=module.params['image_name']
         self.image_base=module.params['image_base']
         self.image_format=module.params['image_format']
         self.image_size=module.params['image_size']
+        self.preallocation=module.params['preallocation']
+        # validate before main() gets a chance to exit early in check mode
+        if self.preallocation not in (None, 'off'):
+            if self.image_base:
+                module.fail_json(msg="preallocation=%s can not be used together with image_base" % self.preallocation)
+            if self.preallocation=='metadata' and (self.image_format or 'qcow2')!='qcow2':
+                module.fail_json(msg="preallocation=metadata requires image_format=qcow2, got %s" % self.image_format)
         # dump additional debug info through syslog
         self.syslogging=True
+        if self.syslogging:
+            syslog.openlog(SYSLOG_IDENT)
+        # resolved binary paths, filled on first lookup by get_bin()
+        self._bins={}
+
+    def get_bin(self, name):
+        # Walk $PATH only once per binary
+        if name not in self._bins:
+            self._bins[name]=self.module.get_bin_path(name, True)
+        return self._bins[name]
 
     def execute_command(self, cmd, use_unsafe_shell=False, data=None):
         if self.syslogging:
-            syslog.openlog('ansible-%s' % os.path.basename(__file__))
             syslog.syslog(syslog.LOG_NOTICE, 'Command %s' % '|'.join(cmd))
 
         return self.module.run_command(cmd, use_unsafe_shell=use_unsafe_shell, data=data)
@@ -179,34 +258,33 @@ class KvmCmd(object):
     def dict_to_string(self, d):
         # Try to trivially translate a dictionary's elements into nice string
         # formatting.
-        dstr=""
-        for key in d:
-            val=d[key]
-            str_val=""
-            add_string=True
-            if type(val)==type(dbus.Array([])):
+        # dbus is only needed here, keep it out of the qemu code paths
+        import dbus
+        parts=[]
+        for key, val in d.items():
+            if isinstance(val, dbus.Array) and val.signature=='y':
+                # byte arrays (MACs, SSIDs...) go through bytearray in C
+                # same "N " per byte output as the element loop below
+                str_val="".join(map("%d ".__mod__, bytearray(val)))
+            elif isinstance(val, dbus.Array):
+                elts=[]
                 for elt in val:
-                    if type(elt)==type(dbus.Byte(1)):
-                        str_val+="%s " % int(elt)
-                    elif type(elt)==type(dbus.String("")):
-                        str_val+="%s" % elt
-            elif type(val)==type(dbus.Dictionary({})):
-                dstr+=self.dict_to_string(val)
-                add_string=False
+                    if isinstance(elt, dbus.Byte):
+                        elts.append("%s " % int(elt))
+                    elif isinstance(elt, dbus.String):
+                        elts.append(elt)
+                str_val="".join(elts)
+            elif isinstance(val, dbus.Dictionary):
+                parts.append(self.dict_to_string(val))
+                continue
             else:
                 str_val=val
-            if add_string:
-                dstr+="%s: %s\n" % ( key, str_val)
-        return dstr
+            parts.append("%s: %s\n" % (key, str_val))
+        return "".join(parts)
 
-    def create_connection_bridge(self):
-        cmd=[self.module.get_bin_path('nmcli', True)]
-        # format for creating bridge interface
-        cmd.append('con')
-        cmd.append('add')
-        cmd.append('type')
-        cmd.append('bridge')
-        cmd.append('con-name')
+    def connection_add_cmd(self, conn_type, extra=()):
+        # common 'nmcli con add' format, extra args go before autoconnect
+        cmd=[self.get_bin('nmcli'), 'con', 'add', 'type', conn_type, 'con-name']
         if self.cname is not None:
             cmd.append(self.cname)
         elif self.ifname is not None:
@@ -219,114 +297,61 @@ class KvmCmd(object):
             cmd.append(self.cname)
         #
         if self.ip4 is not None:
-            cmd.append('ip4')
-            cmd.append(self.ip4)
+            cmd.extend(('ip4', self.ip4))
         if self.gw4 is not None:
-            cmd.append('gw4')
-            cmd.append(self.gw4)
+            cmd.extend(('gw4', self.gw4))
         if self.ip6 is not None:
-            cmd.append('ip6')
-            cmd.append(self.ip6)
+            cmd.extend(('ip6', self.ip6))
         if self.gw6 is not None:
-            cmd.append('gw6')
-            cmd.append(self.gw6)
+            cmd.extend(('gw6', self.gw6))
+        cmd.extend(extra)
         if self.enabled is not None:
-            cmd.append('autoconnect')
-            cmd.append(self.enabled)
+            cmd.extend(('autoconnect', self.enabled))
         return cmd
 
+    def create_connection_team(self):
+        # format for creating team interface, dns is set inline so no
+        # modify/up round-trip is needed afterwards
+        extra=[]
+        if self.dns4 is not None:
+            extra.extend(('ipv4.dns', self.dns4))
+        if self.dns6 is not None:
+            extra.extend(('ipv6.dns', self.dns6))
+        return self.connection_add_cmd('team', extra)
+
+    def create_connection_bridge(self):
+        # format for creating bridge interface
+        return self.connection_add_cmd('bridge')
+
     def modify_connection_bridge(self):
-        cmd=[self.module.get_bin_path('nmcli', True)]
+        cmd=[self.get_bin('nmcli')]
         # format for modifying bridge interface
         return cmd
 
     def create_connection(self):
-        cmd=[]
-        if self.type=='team':
-            # cmd=self.create_connection_team()
-            if (self.dns4 is not None) or (self.dns6 is not None):
-                cmd=self.create_connection_team()
-                self.execute_command(cmd)
-                cmd=self.modify_connection_team()
+        create, modify, cond_attrs, bring_up=self.CONNECTION_TYPES[self.type]
+        cmd=getattr(self, create)()
+        if any(getattr(self, attr) is not None for attr in cond_attrs):
+            # settings nmcli can't take at creation time need a follow-up modify
+            self.execute_command(cmd)
+            cmd=getattr(self, modify)()
+            if bring_up:
                 self.execute_command(cmd)
                 cmd=self.up_connection()
-                return self.execute_command(cmd)
-            elif (self.dns4 is None) or (self.dns6 is None):
-                cmd=self.create_connection_team()
-                return self.execute_command(cmd)
-        elif self.type=='team-slave':
-            if self.mtu is not None:
-                cmd=self.create_connection_team_slave()
-                self.execute_command(cmd)
-                cmd=self.modify_connection_team_slave()
-                self.execute_command(cmd)
-                # cmd=self.up_connection()
-                return self.execute_command(cmd)
-            else:
-                cmd=self.create_connection_team_slave()
-                return self.execute_command(cmd)
-        elif self.type=='bond':
-            if (self.mtu is not None) or (self.dns4 is not None) or (self.dns6 is not None):
-                cmd=self.create_connection_bond()
-                self.execute_command(cmd)
-                cmd=self.modify_connection_bond()
-                self.execute_command(cmd)
-                cmd=self.up_connection()
-                return self.execute_command(cmd)
-            else:
-                cmd=self.create_connection_bond()
-                return self.execute_command(cmd)
-        elif self.type=='bond-slave':
-            cmd=self.create_connection_bond_slave()
-        elif self.type=='ethernet':
-            if (self.mtu is not None) or (self.dns4 is not None) or (self.dns6 is not None):
-                cmd=self.create_connection_ethernet()
-                self.execute_command(cmd)
-                cmd=self.modify_connection_ethernet()
-                self.execute_command(cmd)
-                cmd=self.up_connection()
-                return self.execute_command(cmd)
-            else:
-                cmd=self.create_connection_ethernet()
-                return self.execute_command(cmd)
-        elif self.type=='bridge':
-            cmd=self.create_connection_bridge()
-        elif self.type=='bridge-slave':
-            cmd=self.create_connection_bridge_slave()
-        elif self.type=='vlan':
-            cmd=self.create_connection_vlan()
-        elif self.type=='tun':
-            cmd=self.create_connection_tun()
+        elif bring_up and not cond_attrs and self.enabled=='no':
+            # NetworkManager won't activate it by itself
+            self.execute_command(cmd)
+            cmd=self.up_connection()
         return self.execute_command(cmd)
 
     def remove_connection(self):
         # self.down_connection()
-        cmd=[self.module.get_bin_path('nmcli', True)]
-        cmd.append('con')
-        cmd.append('del')
-        cmd.append(self.cname)
+        cmd=[self.get_bin('nmcli'), 'con', 'del', self.cname]
         return self.execute_command(cmd)
 
     def modify_connection(self):
-        cmd=[]
-        if self.type=='team':
-            cmd=self.modify_connection_team()
-        elif self.type=='team-slave':
-            cmd=self.modify_connection_team_slave()
-        elif self.type=='bond':
-            cmd=self.modify_connection_bond()
-        elif self.type=='bond-slave':
-            cmd=self.modify_connection_bond_slave()
-        elif self.type=='ethernet':
-            cmd=self.modify_connection_ethernet()
-        elif self.type=='bridge':
-            cmd=self.modify_connection_bridge()
-        elif self.type=='bridge-slave':
-            cmd=self.modify_connection_bridge_slave()
-        elif self.type=='vlan':
-            cmd=self.modify_connection_vlan()
-        elif self.type=='tun':
-            cmd=self.modify_connection_tun()
+        modify=self.CONNECTION_TYPES[self.type][1]
+        cmd=getattr(self, modify)()
         return self.execute_command(cmd)
 
     ### Compute Services
@@ -335,38 +360,36 @@ class KvmCmd(object):
             return os.path.exists(self.instance_name)
         return False
     #
-    def instance_show(self):
-        cmd=[self.module.get_bin_path('qemu-img', True)]
-        cmd.append('info')
-        if self.instance_name is not None:
-            cmd.append(self.instance_name)
+    def qemu_img_info(self, name):
+        cmd=[self.get_bin('qemu-img'), 'info']
+        if name is not None:
+            cmd.append(name)
         return self.execute_command(cmd)
+
+    def instance_show(self):
+        return self.qemu_img_info(self.instance_name)
     #
     def create_instance(self):
-        cmd=[self.module.get_bin_path('qemu-img', True)]
         # Create image for instance
         #qemu-img create -f qcow2 -o backing_file=winxp.img test01.img 
         # what is this for?:
         #qemu-img create -b /home/dang/vmimages/base-f24.qcow2 \
         #        -f qcow2 /home/dang/vmimages/f24vm-b.qcow2
-        cmd.append('create')
-        cmd.append('-f')
-        cmd.append(self.image_format)
-        if self.image_base is not None:
-            cmd.append('-o')
-            if self.image_base is not None:
-                #join() takes iterable list!
-                cmd.append("=".join(('backing_file', self.image_base)))
-                #cmd.append(self.image_base)
+        cmd=[self.get_bin('qemu-img'), 'create', '-f', self.image_format or 'qcow2']
+        options=[]
+        if self.image_base:
+            options.append('backing_file=' + self.image_base)
+        if self.preallocation is not None:
+            options.append('preallocation=' + self.preallocation)
+        if options:
+            cmd.extend(('-o', ','.join(options)))
         if self.instance_name is not None:
             cmd.append(self.instance_name)
         if self.image_size is not None:
             cmd.append(self.image_size)
-            pass
         return self.execute_command(cmd)
 
     def instance_boot(self):
-        cmd=[self.module.get_bin_path('qemu-kvm', True)]
         # command to start vm
         #qemu-kvm -hda $DIR/images/Fedora-x86_64-20-300G-20150130-sda-odl.qcow2 \
         #        -cpu core2duo,+vmx -enable-kvm \
@@ -375,33 +398,35 @@ class KvmCmd(object):
         #        -device e1000,netdev=snet0,mac=DE:AD:BE:EF:12:10 -netdev tap,id=snet0,script=$DIR/scripts/qemu-ifup-stackbr0.sh \
         # Create all network and ip-routing in host then just connect vm
         # sudo qemu-kvm -hda instances/controller.qcow2 -m 1024 -vnc :3 -cdrom cloud-init/default/default-cidata.iso -device e1000,netdev=br_ql_mgmt -netdev tap,id=br_ql_mgmt,ifname=controller-eth0,script=no,downscript=no
-        cmd.append('-daemonize')
-        cmd.append('-hda')
+        cmd=[self.get_bin('qemu-kvm')]
+        cmd.extend(self.QEMU_KVM_ARGS)
         if self.instance_name is not None:
-            cmd.append(self.instance_name)
-        if self.instance_cpu is not None:
-            cmd.append('-cpu')
-            cmd.append(self.instance_cpu)
+            if self.instance_disk_bus=='ide':
+                # same as -hda
+                drive='file=%s,if=ide,index=0,media=disk' % self.instance_name
+            else:
+                drive='file=%s,if=none,id=disk0' % self.instance_name
+            # let qemu probe the format like -hda did, unless it was given
+            if self.image_format is not None:
+                drive+=',format=' + self.image_format
+            if self.instance_disk_cache!='default':
+                drive+=',cache=' + self.instance_disk_cache
+                if self.instance_disk_cache in ('none', 'directsync'):
+                    drive+=',aio=native'
+            cmd.extend(('-drive', drive))
+            if self.instance_disk_bus=='virtio':
+                cmd.extend(('-object', 'iothread,id=io1',
+                            '-device', 'virtio-blk-pci,drive=disk0,iothread=io1'))
+        cmd.extend(('-cpu', self.instance_cpu or 'host'))
         if self.instance_cpus is not None:
-            cmd.append('-smp')
-            cmd.append("=".join(('cpus', self.instance_cpus)))
+            cmd.extend(('-smp', "=".join(('cpus', self.instance_cpus))))
         if self.instance_ram is not None:
-            cmd.append('-m')
-            cmd.append(self.instance_ram)
+            cmd.extend(('-m', self.instance_ram))
         if self.instance_vnc is not None:
-            cmd.append('-vnc')
-            cmd.append(self.instance_vnc)
+            cmd.extend(('-vnc', self.instance_vnc))
         # some default
-        cmd.append('-display')
-        if self.instance_display is not None:
-            cmd.append(self.instance_display)
-        else:
-            cmd.append('sdl')
-        cmd.append('-cdrom')
-        if self.instance_cdrom is not None:
-            cmd.append(self.instance_cdrom)
-        else:
-            cmd.append('cloud-init/default/default-cidata.iso')
+        cmd.extend(('-display', self.instance_display or 'sdl'))
+        cmd.extend(('-cdrom', self.instance_cdrom or 'cloud-init/default/default-cidata.iso'))
 
 
         return self.execute_command(cmd)
@@ -412,92 +437,90 @@ class KvmCmd(object):
         return True
 
     def create_image(self):
-        cmd=[self.module.get_bin_path('qemu-img', True)]
+        cmd=[self.get_bin('qemu-img')]
         return self.execute_command(cmd)
 
     def image_show(self):
-        cmd=[self.module.get_bin_path('qemu-img', True)]
-        cmd.append('info')
-        if self.image_name is not None:
-            cmd.append(self.image_name)
-        return self.execute_command(cmd)
+        return self.qemu_img_info(self.image_name)
     ###/
 
     def show(self):
         # Show details of instance
         # action=show instance_name=name
-        print json.dumps({
+        print(json.dumps({
             "time" : date
-        })
+        }))
+
+
+ARGUMENT_SPEC=dict(
+    enabled=dict(required=False, default=None, choices=['yes', 'no'], type='str'),
+    action=dict(required=False, default=None, choices=['add', 'mod', 'show', 'list', 'boot', 'up', 'down', 'del', 'image-list', 'image-show', 'image-create', 'instance-create'], type='str'),
+    state=dict(required=False, default='present', choices=['present', 'absent'], type='str'),
+    # VM argument
+    instance_name=dict(required=False, type='str'),
+    instance_cpu=dict(required=False, type='str'),
+    instance_cpus=dict(required=False, type='str'),
+    instance_ram=dict(required=False, type='str'),
+    instance_vnc=dict(required=False, type='str'),
+    instance_display=dict(required=False, type='str'),
+    instance_cdrom=dict(required=False, type='str'),
+    instance_disk_bus=dict(required=False, default='virtio', choices=['virtio', 'ide'], type='str'),
+    instance_disk_cache=dict(required=False, default='none', choices=['none', 'directsync', 'writeback', 'writethrough', 'unsafe', 'default'], type='str'),
+    image_name=dict(required=False, type='str'),
+    image_base=dict(required=False, type='str'),
+    image_format=dict(required=False, type='str'),
+    image_size=dict(type='str'),
+    preallocation=dict(required=False, default=None, choices=['off', 'metadata', 'falloc', 'full'], type='str'),
+    #
+    cname=dict(required=False, type='str'),
+    master=dict(required=False, default=None, type='str'),
+    autoconnect=dict(required=False, default=None, choices=['yes', 'no'], type='str'),
+    ifname=dict(required=False, default=None, type='str'),
+    type=dict(required=False, default=None, choices=['ethernet', 'team', 'team-slave', 'bond', 'bond-slave', 'bridge', 'vlan', 'tun'], type='str'),
+    ip4=dict(required=False, default=None, type='str'),
+    gw4=dict(required=False, default=None, type='str'),
+    dns4=dict(required=False, default=None, type='str'),
+    ip6=dict(required=False, default=None, type='str'),
+    gw6=dict(required=False, default=None, type='str'),
+    dns6=dict(required=False, default=None, type='str'),
+    slavetype=dict(required=False, default=None, choices=['team', 'bond', 'bridge'], type='str'),
+    # Bond Specific vars
+    mode=dict(require=False, default="balance-rr", choices=["balance-rr", "active-backup", "balance-xor", "broadcast", "802.3ad", "balance-tlb", "balance-alb", "tun", "tap"], type='str'),
+    # Tun Specific vars
+    owner=dict(require=False, default=None, type='str'),
+    group=dict(require=False, default=None, type='str'),
+    miimon=dict(required=False, default=None, type='str'),
+    downdelay=dict(required=False, default=None, type='str'),
+    updelay=dict(required=False, default=None, type='str'),
+    arp_interval=dict(required=False, default=None, type='str'),
+    arp_ip_target=dict(required=False, default=None, type='str'),
+    # general usage
+    mtu=dict(required=False, default=None, type='str'),
+    mac=dict(required=False, default=None, type='str'),
+    # bridge specific vars
+    stp=dict(required=False, default='yes', choices=['yes', 'no'], type='str'),
+    priority=dict(required=False, default="128", type='str'),
+    slavepriority=dict(required=False, default="32", type='str'),
+    forwarddelay=dict(required=False, default="15", type='str'),
+    hellotime=dict(required=False, default="2", type='str'),
+    maxage=dict(required=False, default="20", type='str'),
+    ageingtime=dict(required=False, default="300", type='str'),
+    # vlan specific vars
+    vlanid=dict(required=False, default=None, type='str'),
+    vlandev=dict(required=False, default=None, type='str'),
+    flags=dict(required=False, default=None, type='str'),
+    ingress=dict(required=False, default=None, type='str'),
+    egress=dict(required=False, default=None, type='str'),
+)
 
 
 def main():
     # Parsing argument file
-    module=AnsibleModule(
-        argument_spec=dict(
-            enabled=dict(required=False, default=None, choices=['yes', 'no'], type='str'),
-            action=dict(required=False, default=None, choices=['add', 'mod', 'show', 'list', 'boot', 'up', 'down', 'del', 'image-list', 'image-show', 'image-create', 'instance-create'], type='str'),
-            state=dict(required=False, default='present', choices=['present', 'absent'], type='str'),
-            # VM argument
-            instance_name=dict(required=False, type='str'),
-            instance_cpu=dict(required=False, type='str'),
-            instance_cpus=dict(required=False, type='str'),
-            instance_ram=dict(required=False, type='str'),
-            instance_vnc=dict(required=False, type='str'),
-            instance_display=dict(required=False, type='str'),
-            instance_cdrom=dict(required=False, type='str'),
-            image_name=dict(required=False, type='str'),
-            image_base=dict(required=False, type='str'),
-            image_format=dict(required=False, type='str', default='qcow2'),
-            image_size=dict(type='str'),
-            #
-            cname=dict(required=False, type='str'),
-            master=dict(required=False, default=None, type='str'),
-            autoconnect=dict(required=False, default=None, choices=['yes', 'no'], type='str'),
-            ifname=dict(required=False, default=None, type='str'),
-            type=dict(required=False, default=None, choices=['ethernet', 'team', 'team-slave', 'bond', 'bond-slave', 'bridge', 'vlan', 'tun'], type='str'),
-            ip4=dict(required=False, default=None, type='str'),
-            gw4=dict(required=False, default=None, type='str'),
-            dns4=dict(required=False, default=None, type='str'),
-            ip6=dict(required=False, default=None, type='str'),
-            gw6=dict(required=False, default=None, type='str'),
-            dns6=dict(required=False, default=None, type='str'),
-            slavetype=dict(required=False, default=None, choices=['team', 'bond', 'bridge'], type='str'),
-            # Bond Specific vars
-            mode=dict(require=False, default="balance-rr", choices=["balance-rr", "active-backup", "balance-xor", "broadcast", "802.3ad", "balance-tlb", "balance-alb", "tun", "tap"], type='str'),
-            # Tun Specific vars
-            owner=dict(require=False, default=None, type='str'),
-            group=dict(require=False, default=None, type='str'),
-            miimon=dict(required=False, default=None, type='str'),
-            downdelay=dict(required=False, default=None, type='str'),
-            updelay=dict(required=False, default=None, type='str'),
-            arp_interval=dict(required=False, default=None, type='str'),
-            arp_ip_target=dict(required=False, default=None, type='str'),
-            # general usage
-            mtu=dict(required=False, default=None, type='str'),
-            mac=dict(required=False, default=None, type='str'),
-            # bridge specific vars
-            stp=dict(required=False, default='yes', choices=['yes', 'no'], type='str'),
-            priority=dict(required=False, default="128", type='str'),
-            slavepriority=dict(required=False, default="32", type='str'),
-            forwarddelay=dict(required=False, default="15", type='str'),
-            hellotime=dict(required=False, default="2", type='str'),
-            maxage=dict(required=False, default="20", type='str'),
-            ageingtime=dict(required=False, default="300", type='str'),
-            # vlan specific vars
-            vlanid=dict(required=False, default=None, type='str'),
-            vlandev=dict(required=False, default=None, type='str'),
-            flags=dict(required=False, default=None, type='str'),
-            ingress=dict(required=False, default=None, type='str'),
-            egress=dict(required=False, default=None, type='str'),
-        ),
-        supports_check_mode=True
-    )
+    module=AnsibleModule(argument_spec=ARGUMENT_SPEC, supports_check_mode=True)
 
     kvmCmd=KvmCmd(module)
 
     if kvmCmd.syslogging:
-        syslog.openlog('ansible-%s' % os.path.basename(__file__))
         syslog.syslog(syslog.LOG_NOTICE, 'KvmCmd instantiated - platform %s' % kvmCmd.platform)
         if kvmCmd.distribution:
             syslog.syslog(syslog.LOG_NOTICE, 'Nuser instantiated - distribution %s' % kvmCmd.distribution)
@@ -529,7 +552,7 @@ def main():
             module.fail_json(name =('No Image named %s exists' % kvmCmd.cname), msg=err, rc=rc)
     ### /-
     ## Show image
-    if kvmCmd.action == 'image-show':
+    elif kvmCmd.action == 'image-show':
         if kvmCmd.image_exists():
             #result['Image']=('Image %s is being added' % (kvmCmd.image_name))
             (rc, out, err)=kvmCmd.image_show()
@@ -543,9 +566,11 @@ def main():
     ### Compute Service
 
     ## Create vm instance
-    if kvmCmd.action == 'instance-create':
+    elif kvmCmd.action == 'instance-create':
+        # stat the image once, it may sit on a network mount
+        exists=kvmCmd.instance_exists()
         if kvmCmd.state=='absent':
-            if kvmCmd.instance_exists():
+            if exists:
                 if module.check_mode:
                     module.exit_json(changed=True)
                 #(rc, out, err)=nmcli.down_connection()
@@ -554,15 +579,15 @@ def main():
                 module.fail_json(name =('No Instance named %s exists' % kvmCmd.instance_name), msg=err, rc=rc)
         # fi
         elif kvmCmd.state=='present':
-            if kvmCmd.instance_exists():
+            if exists:
                 result['Exists']='Instance do exist so we are modifying them'
                 # do modify
                 if module.check_mode:
                     module.exit_json(changed=True) # exit_json ends program!
                 (rc, out, err)=kvmCmd.instance_show()
             #
-            if not kvmCmd.instance_exists():
-                result['Instance']=('Instance %s, base %s, format %s (default qcow2), Size %s (M) is being added' % (kvmCmd.instance_name, kvmCmd.image_base, kvmCmd.image_format, kvmCmd.image_size))
+            if not exists:
+                result['Instance']=('Instance %s, base %s, format %s (default qcow2), Size %s (M) is being added' % (kvmCmd.instance_name, kvmCmd.image_base, kvmCmd.image_format or 'qcow2', kvmCmd.image_size))
                 if module.check_mode:
                     module.exit_json(changed=True)
                 (rc, out, err)=kvmCmd.create_instance()
@@ -571,9 +596,10 @@ def main():
     ### /-
 
     ## Boot vm instance
-    if kvmCmd.action == 'boot':
+    elif kvmCmd.action == 'boot':
+        exists=kvmCmd.instance_exists()
         if kvmCmd.state=='absent':
-            if kvmCmd.instance_exists():
+            if exists:
                 if module.check_mode:
                     module.exit_json(changed=True)
                 #(rc, out, err)=nmcli.down_connection()
@@ -582,25 +608,28 @@ def main():
                 module.fail_json(name =('No Instance named %s exists' % kvmCmd.instance_name), msg=err, rc=rc)
         # fi
         elif kvmCmd.state=='present':
-            if not kvmCmd.instance_exists():
+            if module.check_mode:
+                module.exit_json(changed=True)
+            if not exists:
+                # qemu-kvm can't materialise the overlay on open (-snapshot
+                # overlays are thrown away on exit), so qemu-img runs first
                 result['Not Exists']='Instance not exist. Trying to Create instance'
                 (rc, out, err)=kvmCmd.create_instance()
-                (rc, out, err)=kvmCmd.instance_boot()
-                # do modify
-            if kvmCmd.instance_exists():
-                result['Instance']=('Instance %s, cpu %s, ram %s, vnc %s, cdrom %s is being booted' % (kvmCmd.instance_name, kvmCmd.instance_cpus, kvmCmd.instance_ram, kvmCmd.instance_vnc, kvmCmd.instance_cdrom))
-                if module.check_mode:
-                    module.exit_json(changed=True)
-                (rc, out, err)=kvmCmd.instance_boot()
+                if rc!=0:
+                    module.fail_json(name =('Instance named %s can not be created' % kvmCmd.instance_name), msg=err, rc=rc)
+            # boot exactly once, whether the instance was just created or not
+            result['Instance']=('Instance %s, cpu %s, ram %s, vnc %s, cdrom %s is being booted' % (kvmCmd.instance_name, kvmCmd.instance_cpus, kvmCmd.instance_ram, kvmCmd.instance_vnc, kvmCmd.instance_cdrom))
+            (rc, out, err)=kvmCmd.instance_boot()
             if rc is not None and rc!=0:
                 module.fail_json(name =('Instance named %s can not boot' % kvmCmd.instance_name), msg=err, rc=rc)
     ## /-
 
     ## Show details of instance
-    if kvmCmd.action == 'show':
-        if kvmCmd.instance_exists():
+    elif kvmCmd.action == 'show':
+        exists=kvmCmd.instance_exists()
+        if exists:
             pass
-        if not kvmCmd.instance_exists():
+        if not exists:
             result['Instance']=('Instance %s not exist' % (kvmCmd.instance_name))
             module.fail_json(name =('No Instance named %s exists' % kvmCmd.instance_name), msg='Instance not exists')
     ## /